@@ -1,22 +1,43 @@
 
 import os
+import atexit
 import sys
 import hashlib
+import hmac
 import sqlite3
 import json
+import mmap
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import streamlit as st
 
-# Prefer pysqlite3 (bundled SQLite with FTS5) on Streamlit Cloud
+# Prefer pysqlite3 (bundled SQLite with FTS5) on Streamlit Cloud.
+# O `import sqlite3` acima já ligou o nome ao módulo da stdlib: sem rebind,
+# as conexões deste arquivo nunca usariam o pysqlite3.
 try:
     import pysqlite3  # type: ignore
     sys.modules['sqlite3'] = pysqlite3
+    sqlite3 = pysqlite3
 except Exception:
     pass
 
 from PyPDF2 import PdfReader
+
+# PDFium (motor de PDF do Chrome) extrai texto bem mais rápido que o PyPDF2
+try:
+    import pypdfium2 as pdfium
+    HAS_PDFIUM = True
+except ImportError:
+    HAS_PDFIUM = False
+    pdfium = None
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Iterable, Iterator
 
 APP_TITLE = "Origin Software Agent"
 DEFAULT_DOCS_DIR = "docs/origin"
@@ -27,6 +48,126 @@ USER_DB_PATH = os.path.join(DATA_DIR, "users.db")
 CHUNK_SIZE = 1200
 CHUNK_OVERLAP = 150
 TOP_K = 6
+ANSWER_MEMO_SIZE = 512
+PDF_BATCH_SIZE = 4
+# Fixo por processo: é o prefixo do prompt cache da Anthropic
+SYSTEM_PROMPT = (
+    "Você é um assistente técnico. Responda de forma direta e cite trechos do contexto quando possível. "
+    "Se a informação não estiver nos documentos, diga que não encontrou."
+    "\nUse EXCLUSIVAMENTE o contexto fornecido."
+)
+
+# =============================================================================
+# CONEXÕES SQLITE
+# =============================================================================
+
+SQLITE_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA mmap_size=268435456;
+"""
+
+# Índice FTS5 com conteúdo externo: o texto fica apenas em chunks.
+# remove_diacritics faz "importacao" casar com "Importação" nos PDFs em português;
+# sem o porter (stemmer inglês), as variações são cobertas por busca de prefixo.
+# Mudar esta DDL recria e reindexa chunks_fts em ensure_dirs_and_dbs.
+CHUNKS_FTS_SQL = (
+    "CREATE VIRTUAL TABLE chunks_fts USING fts5("
+    "text, content='chunks', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')"
+)
+FTS_PREFIX_MIN_LEN = 4
+CHUNKS_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+        INSERT INTO chunks_fts(rowid, text) VALUES (new.id, new.text);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+        INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chunks_au AFTER UPDATE OF text ON chunks BEGIN
+        INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO chunks_fts(rowid, text) VALUES (new.id, new.text);
+    END;
+    """,
+]
+
+def _probe_fts5() -> bool:
+    """Verifica uma vez, num banco em memória, se o SQLite deste ambiente tem FTS5"""
+    con = sqlite3.connect(":memory:")
+    try:
+        con.execute("CREATE VIRTUAL TABLE probe USING fts5(x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        con.close()
+
+# Sem FTS5 a busca fica desativada: um LIKE '%...%' varreria a tabela toda
+HAS_FTS5 = _probe_fts5()
+
+def _connect(path: str) -> sqlite3.Connection:
+    """Abre conexão SQLite com WAL e PRAGMAs de desempenho"""
+    # Streamlit pode atender reruns em threads diferentes
+    con = sqlite3.connect(path, check_same_thread=False)
+    con.executescript(SQLITE_PRAGMAS)
+    return con
+
+def _optimize_and_close(con: sqlite3.Connection):
+    """Atualiza as estatísticas do planner e fecha a conexão ao encerrar o processo"""
+    try:
+        con.execute("PRAGMA optimize")
+        con.close()
+    except sqlite3.Error:
+        pass
+
+@st.cache_resource
+def _shared_conn(path: str) -> Tuple[sqlite3.Connection, threading.RLock]:
+    """Conexão persistente por banco e o lock que dá exclusividade sobre ela"""
+    con = _connect(path)
+    atexit.register(_optimize_and_close, con)
+    return con, threading.RLock()
+
+@contextmanager
+def get_conn(path: str) -> Iterator[sqlite3.Connection]:
+    """Usa a conexão do banco, reaproveitada durante toda a vida do processo.
+
+    A conexão é compartilhada pelas sessões (threads) do Streamlit e a
+    transação pertence à conexão: o lock garante que o commit/rollback do
+    `with` de uma sessão não leve junto as instruções de outra.
+    """
+    con, lock = _shared_conn(path)
+    with lock, con:
+        yield con
+
+@st.cache_resource
+def get_doc_writer() -> Tuple[sqlite3.Connection, threading.Lock]:
+    """Conexão de escrita dedicada à indexação e o lock que serializa as cargas.
+
+    As transações de index_folder ficam fora da conexão compartilhada:
+    com WAL, as buscas das outras sessões seguem lendo o último commit.
+    """
+    con = _connect(DOC_DB_PATH)
+    atexit.register(_optimize_and_close, con)
+    return con, threading.Lock()
+
+def db_stamp(db_file: str) -> Tuple[int, ...]:
+    """Assinatura (mtime, tamanho) do DB e do -wal: com WAL, um commit pode
+    alterar só o -wal, então os dois entram"""
+    stamp = []
+    for path in (db_file, db_file + "-wal"):
+        try:
+            st_ = os.stat(path)
+            stamp += [st_.st_mtime_ns, st_.st_size]
+        except OSError:
+            stamp += [0, 0]
+    return tuple(stamp)
 
 # =============================================================================
 # CLOUDFLARE R2 STORAGE - VERSÃO CORRIGIDA
@@ -36,6 +177,7 @@ try:
     import boto3
     from botocore.exceptions import ClientError, NoCredentialsError
     from botocore.config import Config
+    from boto3.s3.transfer import TransferConfig
     HAS_S3 = True
 except ImportError:
     HAS_S3 = False
@@ -43,11 +185,12 @@ except ImportError:
     ClientError = Exception
     NoCredentialsError = Exception
 
-def get_r2_config() -> Optional[Dict]:
-    """Obtém configuração do R2 de forma robusta"""
-    if not HAS_S3:
-        return None
-    
+R2_PREFIX = "origin-agent/"
+R2_MANIFEST_PATH = os.path.join(DATA_DIR, ".r2_manifest.json")
+R2_REQUIRED_KEYS = ['endpoint', 'bucket', 'access_key', 'secret_key']
+
+def read_r2_config() -> Dict:
+    """Lê a configuração do R2 de st.secrets/env, sem cache (valores podem faltar)"""
     # Tentar múltiplas formas de obter as configurações
     config = {}
     
@@ -74,20 +217,29 @@ def get_r2_config() -> Optional[Dict]:
     if not config.get('region'):
         config['region'] = os.getenv("S3_REGION", "auto")
     
+    return config
+
+@st.cache_resource
+def get_r2_config() -> Optional[Dict]:
+    """Obtém configuração do R2 uma vez por processo (limpa em "Testar Conexão")"""
+    if not HAS_S3:
+        return None
+    
+    config = read_r2_config()
+    
     # Validar se todas as configurações necessárias estão presentes
-    required = ['endpoint', 'bucket', 'access_key', 'secret_key']
-    for key in required:
+    for key in R2_REQUIRED_KEYS:
         if not config.get(key):
             return None
     
     return config
 
-def get_r2_client():
-    """Configura cliente R2 com tratamento de erros melhorado"""
+def connect_r2(config: Optional[Dict] = None):
+    """Configura cliente R2 e testa o bucket (sempre faz a chamada de rede)"""
     if not HAS_S3:
         return None
     
-    config = get_r2_config()
+    config = config or get_r2_config()
     if not config:
         return None
     
@@ -124,39 +276,114 @@ def get_r2_client():
         return {
             "client": client, 
             "bucket": config['bucket'], 
-            "prefix": "origin-agent/"
+            "prefix": R2_PREFIX
         }
         
     except Exception as e:
         print(f"[R2] Erro ao conectar: {str(e)}")
         return None
 
+@st.cache_resource
+def _cached_r2_client():
+    """Cliente R2 criado uma vez por processo (sem head_bucket a cada rerun)"""
+    r2 = connect_r2()
+    if r2 is None:
+        # Exceção não entra no cache: a próxima chamada tenta conectar de novo
+        raise ConnectionError("R2 indisponível")
+    return r2
+
+def get_r2_client():
+    """Cliente R2 em cache, ou None se o R2 não estiver configurado/acessível"""
+    try:
+        return _cached_r2_client()
+    except ConnectionError:
+        return None
+
 def r2_key(filename: str) -> str:
     """Gera chave do R2 com prefixo"""
-    r2 = get_r2_client()
-    prefix = r2["prefix"] if r2 else "origin-agent/"
-    return f"{prefix}{filename}"
+    return f"{R2_PREFIX}{filename}"
+
+def load_r2_manifest() -> Dict[str, Dict]:
+    """Lê o manifesto local: {"stamp", "sha256"} do último upload de cada DB"""
+    try:
+        with open(R2_MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_r2_manifest(manifest: Dict[str, Dict]):
+    """Grava o manifesto de forma atômica"""
+    tmp_path = R2_MANIFEST_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, R2_MANIFEST_PATH)
+    except OSError as e:
+        print(f"[R2] Erro ao salvar manifesto: {str(e)}")
 
-def backup_to_r2():
-    """Faz backup dos DBs para R2"""
+def snapshot_db(db_file: str) -> str:
+    """Cópia consistente do DB (inclui o -wal) via backup API; retorna o arquivo temporário"""
+    fd, snapshot_path = tempfile.mkstemp(suffix=".db", dir=DATA_DIR)
+    os.close(fd)
+    # Conexão própria: só enxerga transações confirmadas, mesmo com index_folder em andamento
+    src = sqlite3.connect(db_file)
+    dst = sqlite3.connect(snapshot_path)
+    try:
+        src.backup(dst)
+    except sqlite3.Error:
+        dst.close()
+        os.unlink(snapshot_path)
+        raise
+    finally:
+        src.close()
+    dst.close()
+    return snapshot_path
+
+def backup_to_r2(force: bool = False):
+    """Faz backup para o R2 apenas dos DBs que mudaram desde o último upload"""
     r2 = get_r2_client()
     if not r2:
         return False
     
     client = r2["client"]
     bucket = r2["bucket"]
+    # Multipart em paralelo para DBs grandes
+    transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4)
+    manifest = load_r2_manifest()
+    changed = False
     
     success = True
     for db_file in [USER_DB_PATH, DOC_DB_PATH, CHAT_DB_PATH]:
         if os.path.exists(db_file):
+            key = r2_key(os.path.basename(db_file))
+            manifest_key = f"{bucket}/{key}"
+            entry = manifest.get(manifest_key)
+            if not isinstance(entry, dict):
+                entry = {}
+            # Caminho comum (rerun sem escrita): só um stat, sem cópia nem hash.
+            # O stamp é lido antes do snapshot: uma escrita no meio só causa
+            # um novo snapshot na próxima chamada, nunca um upload perdido
+            stamp = list(db_stamp(db_file))
+            if not force and entry.get("stamp") == stamp:
+                continue
+            snapshot_path = None
             try:
-                key = r2_key(os.path.basename(db_file))
-                client.upload_file(db_file, bucket, key)
-                print(f"[R2] Backup: {db_file} -> {key}")
+                snapshot_path = snapshot_db(db_file)
+                digest = file_sha256(snapshot_path)
+                if force or entry.get("sha256") != digest:
+                    client.upload_file(snapshot_path, bucket, key, Config=transfer_config)
+                    print(f"[R2] Backup: {db_file} -> {key}")
+                manifest[manifest_key] = {"stamp": stamp, "sha256": digest}
+                changed = True
             except Exception as e:
                 print(f"[R2] Erro no backup {db_file}: {str(e)}")
                 success = False
+            finally:
+                if snapshot_path:
+                    os.unlink(snapshot_path)
     
+    if changed:
+        save_r2_manifest(manifest)
     return success
 
 def restore_from_r2():
@@ -197,20 +424,17 @@ def test_r2_connection():
     if not HAS_S3:
         return {"status": "error", "message": "boto3 não instalado"}
     
-    config = get_r2_config()
-    if not config:
-        missing = []
-        test_config = get_r2_config() or {}
-        for key in ['endpoint', 'bucket', 'access_key', 'secret_key']:
-            if not test_config.get(key):
-                missing.append(key.upper())
+    # Diagnóstico relê secrets/env de propósito, sem mexer no cache do processo
+    config = read_r2_config()
+    missing = [key.upper() for key in R2_REQUIRED_KEYS if not config.get(key)]
+    if missing:
         return {
             "status": "error", 
             "message": f"Configurações faltando: {', '.join(missing)}"
         }
     
-    # Tentar conectar
-    r2 = get_r2_client()
+    # Tentar conectar (sem cache: o diagnóstico precisa de um head_bucket real)
+    r2 = connect_r2(config)
     if r2:
         return {
             "status": "success",
@@ -228,13 +452,44 @@ def test_r2_connection():
 # SISTEMA DE AUTENTICAÇÃO
 # =============================================================================
 
-def hash_password(password: str) -> str:
-    """Cria hash seguro da senha"""
+def new_salt() -> str:
+    """Gera salt aleatório (hex) para um usuário"""
+    return os.urandom(16).hex()
+
+def hash_password(password: str, salt: str) -> str:
+    """Deriva a senha com scrypt (memory-hard) usando o salt do usuário"""
+    return hashlib.scrypt(
+        password.encode(), salt=bytes.fromhex(salt),
+        n=2**14, r=8, p=1, dklen=32
+    ).hex()
+
+def legacy_hash_password(password: str) -> str:
+    """Hash antigo (SHA-256 sem salt), usado só para migrar contas existentes"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+@st.cache_resource
+def _auth_secret() -> bytes:
+    """Segredo do processo usado para assinar os tokens de sessão"""
+    return os.urandom(32)
+
+def session_token(username: str) -> str:
+    """Token HMAC que prova que esta sessão já validou as credenciais"""
+    if "session_nonce" not in st.session_state:
+        st.session_state.session_nonce = os.urandom(16).hex()
+    message = f"{username}:{st.session_state.session_nonce}".encode()
+    return hmac.new(_auth_secret(), message, hashlib.sha256).hexdigest()
+
+def is_authenticated() -> bool:
+    """Confere o token da sessão sem rodar o KDF novamente"""
+    username = st.session_state.get("username")
+    token = st.session_state.get("auth_token")
+    if not st.session_state.get("authenticated") or not username or not token:
+        return False
+    return hmac.compare_digest(token, session_token(username))
+
 def create_user_db():
     """Cria tabela de usuários"""
-    with sqlite3.connect(USER_DB_PATH) as con:
+    with get_conn(USER_DB_PATH) as con:
         cur = con.cursor()
         cur.execute("""
             CREATE TABLE IF NOT EXISTS users(
@@ -245,100 +500,131 @@ def create_user_db():
                 created_at TEXT,
                 last_login TEXT,
                 active INTEGER DEFAULT 1,
-                subscription_expires TEXT
+                subscription_expires TEXT,
+                salt TEXT
             );
         """)
         
+        # Só há o que enviar ao R2 se este rerun alterou o banco
+        changed = False
+        
+        # Bancos antigos: coluna de salt para o scrypt
+        cur.execute("PRAGMA table_info(users)")
+        if "salt" not in [row[1] for row in cur.fetchall()]:
+            cur.execute("ALTER TABLE users ADD COLUMN salt TEXT")
+            changed = True
+        
         # Criar usuário admin padrão se não existir
         cur.execute("SELECT id FROM users WHERE username = 'admin'")
         if not cur.fetchone():
-            admin_pass = hash_password("admin123")  # MUDE ESTA SENHA!
+            changed = True
+            admin_salt = new_salt()
+            admin_pass = hash_password("admin123", admin_salt)  # MUDE ESTA SENHA!
             cur.execute("""
-                INSERT INTO users(username, password_hash, email, created_at, active, subscription_expires)
-                VALUES(?, ?, ?, ?, 1, ?)
-            """, ("admin", admin_pass, "admin@origin.com", 
+                INSERT INTO users(username, password_hash, salt, email, created_at, active, subscription_expires)
+                VALUES(?, ?, ?, ?, ?, 1, ?)
+            """, ("admin", admin_pass, admin_salt, "admin@origin.com", 
                   datetime.utcnow().isoformat(),
                   (datetime.utcnow() + timedelta(days=365)).isoformat()))
         
         con.commit()
     
     # Backup automático para R2
-    sync_user_data()
+    if changed:
+        sync_user_data()
 
 def validate_user(username: str, password: str) -> bool:
     """Valida credenciais do usuário"""
     if not username or not password:
         return False
     
-    with sqlite3.connect(USER_DB_PATH) as con:
+    with get_conn(USER_DB_PATH) as con:
         cur = con.cursor()
         cur.execute("""
-            SELECT password_hash, active, subscription_expires 
+            SELECT password_hash, salt, active, subscription_expires 
             FROM users WHERE username = ?
         """, (username,))
         result = cur.fetchone()
-        
-        if not result:
+    
+    if not result:
+        return False
+    
+    password_hash, salt, active, subscription_expires = result
+    
+    # Verificar senha (comparação em tempo constante); o KDF roda fora do
+    # lock da conexão para não enfileirar os logins das outras sessões
+    new_hash = None
+    if salt:
+        if not hmac.compare_digest(hash_password(password, salt), password_hash):
             return False
-        
-        password_hash, active, subscription_expires = result
-        
-        # Verificar senha
-        if hash_password(password) != password_hash:
+    else:
+        # Conta com hash SHA-256 legado: valida e migra para scrypt
+        if not hmac.compare_digest(legacy_hash_password(password), password_hash):
             return False
-        
-        # Verificar se usuário está ativo
-        if not active:
-            st.error("Usuário desativado. Entre em contato com o suporte.")
+        salt = new_salt()
+        new_hash = hash_password(password, salt)
+    
+    # Verificar se usuário está ativo
+    if not active:
+        st.error("Usuário desativado. Entre em contato com o suporte.")
+        return False
+    
+    # Verificar se assinatura não expirou
+    if subscription_expires:
+        expiry = datetime.fromisoformat(subscription_expires)
+        if datetime.utcnow() > expiry:
+            st.error("Assinatura expirada. Renove seu acesso.")
             return False
-        
-        # Verificar se assinatura não expirou
-        if subscription_expires:
-            expiry = datetime.fromisoformat(subscription_expires)
-            if datetime.utcnow() > expiry:
-                st.error("Assinatura expirada. Renove seu acesso.")
-                return False
-        
+    
+    with get_conn(USER_DB_PATH) as con:
+        cur = con.cursor()
+        if new_hash:
+            cur.execute(
+                "UPDATE users SET password_hash = ?, salt = ? WHERE username = ?",
+                (new_hash, salt, username)
+            )
         # Atualizar último login
         cur.execute(
             "UPDATE users SET last_login = ? WHERE username = ?",
             (datetime.utcnow().isoformat(), username)
         )
         con.commit()
-        
-        # Backup após atualização
-        sync_user_data()
-        
-        return True
+    
+    # Backup após atualização (fora do lock: é chamada de rede)
+    sync_user_data()
+    
+    return True
 
 def add_user(username: str, password: str, email: str = "", months: int = 12) -> bool:
     """Adiciona novo usuário (apenas admin)"""
     if 'username' not in st.session_state or st.session_state.username != 'admin':
         return False
     
-    with sqlite3.connect(USER_DB_PATH) as con:
-        cur = con.cursor()
-        try:
-            expiry = datetime.utcnow() + timedelta(days=30*months)
+    expiry = datetime.utcnow() + timedelta(days=30*months)
+    salt = new_salt()
+    password_hash = hash_password(password, salt)
+    try:
+        with get_conn(USER_DB_PATH) as con:
+            cur = con.cursor()
             cur.execute("""
-                INSERT INTO users(username, password_hash, email, created_at, active, subscription_expires)
-                VALUES(?, ?, ?, ?, 1, ?)
-            """, (username, hash_password(password), email, 
+                INSERT INTO users(username, password_hash, salt, email, created_at, active, subscription_expires)
+                VALUES(?, ?, ?, ?, ?, 1, ?)
+            """, (username, password_hash, salt, email, 
                   datetime.utcnow().isoformat(), expiry.isoformat()))
             con.commit()
-            
-            # Backup após criação
-            sync_user_data()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+    except sqlite3.IntegrityError:
+        return False
+    
+    # Backup após criação
+    sync_user_data()
+    return True
 
 def list_users():
     """Lista usuários (apenas admin)"""
     if 'username' not in st.session_state or st.session_state.username != 'admin':
         return []
     
-    with sqlite3.connect(USER_DB_PATH) as con:
+    with get_conn(USER_DB_PATH) as con:
         cur = con.cursor()
         cur.execute("""
             SELECT username, email, created_at, last_login, active, subscription_expires
@@ -371,6 +657,7 @@ def show_login_page():
                     if validate_user(username, password):
                         st.session_state.authenticated = True
                         st.session_state.username = username
+                        st.session_state.auth_token = session_token(username)
                         st.success("Login realizado com sucesso!")
                         st.rerun()
                     else:
@@ -401,7 +688,7 @@ def show_admin_panel():
         with col1:
             if st.button("📤 Backup Manual", key="manual_backup"):
                 with st.spinner("Fazendo backup..."):
-                    if backup_to_r2():
+                    if backup_to_r2(force=True):
                         st.success("✅ Backup realizado!")
                     else:
                         st.error("❌ Erro no backup")
@@ -417,6 +704,8 @@ def show_admin_panel():
         
         with col3:
             if st.button("🔄 Testar Conexão", key="test_connection"):
+                get_r2_config.clear()
+                _cached_r2_client.clear()
                 st.rerun()
     else:
         st.error(f"❌ R2 não conectado: {r2_status['message']}")
@@ -504,8 +793,9 @@ def show_admin_panel():
 # FUNÇÕES ORIGINAIS (mantidas)
 # =============================================================================
 
-def get_anthropic_client():
-    """Obtém cliente Anthropic de forma robusta"""
+@st.cache_resource
+def _cached_anthropic_client():
+    """Cliente Anthropic criado uma vez por processo (reaproveitando conexões HTTP)"""
     api_key = None
     
     # Tentar várias formas de obter a API key
@@ -519,27 +809,40 @@ def get_anthropic_client():
         api_key = os.environ.get("ANTHROPIC_API_KEY", "")
     
     if not api_key:
-        return None, None
+        # Exceção não entra no cache: uma key adicionada depois é vista no próximo rerun
+        raise LookupError("ANTHROPIC_API_KEY não configurada")
+    
+    import anthropic
+    client = anthropic.Anthropic(api_key=api_key)
     
+    # Obter modelo
+    model = "claude-3-5-sonnet-20240620"  # Modelo padrão
     try:
-        import anthropic
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        # Obter modelo
-        model = "claude-3-5-sonnet-20240620"  # Modelo padrão
-        try:
-            if hasattr(st, 'secrets') and "ANTHROPIC_MODEL" in st.secrets:
-                model = st.secrets["ANTHROPIC_MODEL"]
-        except Exception:
-            model = os.environ.get("ANTHROPIC_MODEL", model)
-        
-        return client, model
+        if hasattr(st, 'secrets') and "ANTHROPIC_MODEL" in st.secrets:
+            model = st.secrets["ANTHROPIC_MODEL"]
+    except Exception:
+        model = os.environ.get("ANTHROPIC_MODEL", model)
+    
+    return client, model
+
+def get_anthropic_client():
+    """Obtém cliente Anthropic de forma robusta; (None, None) sem key ou SDK"""
+    try:
+        return _cached_anthropic_client()
+    except LookupError:
+        return None, None
     except Exception as e:
         st.warning(f"Falha ao carregar Anthropic: {e}")
         return None, None
 
+@st.cache_resource
 def ensure_dirs_and_dbs():
-    """Cria diretórios e bancos de dados necessários"""
+    """Cria diretórios e bancos de dados necessários, uma vez por processo.
+
+    Roda DDL e migrações: repetido a cada rerun, disputaria o lock de escrita
+    com index_folder e travaria a sessão (e a conexão compartilhada) em
+    "database is locked".
+    """
     os.makedirs(DATA_DIR, exist_ok=True)
     
     # Primeiro tenta restaurar do R2
@@ -548,7 +851,7 @@ def ensure_dirs_and_dbs():
     # Depois cria estruturas se necessário
     create_user_db()
     
-    with sqlite3.connect(DOC_DB_PATH) as con:
+    with get_conn(DOC_DB_PATH) as con:
         cur = con.cursor()
         cur.execute("""
             CREATE TABLE IF NOT EXISTS documents(
@@ -556,28 +859,85 @@ def ensure_dirs_and_dbs():
                 filename TEXT NOT NULL,
                 path TEXT NOT NULL,
                 n_pages INTEGER,
-                added_at TEXT
+                added_at TEXT,
+                sha256 TEXT
             );
         """)
+        # Bancos antigos: coluna de hash do conteúdo para deduplicar PDFs
+        cur.execute("PRAGMA table_info(documents)")
+        if "sha256" not in [row[1] for row in cur.fetchall()]:
+            cur.execute("ALTER TABLE documents ADD COLUMN sha256 TEXT")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_documents_path ON documents(path);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_sha ON documents(sha256);")
         cur.execute("""
             CREATE TABLE IF NOT EXISTS chunks(
                 id INTEGER PRIMARY KEY,
                 document_id INTEGER,
                 chunk_index INTEGER,
                 text TEXT,
+                text_hash BLOB,
                 FOREIGN KEY(document_id) REFERENCES documents(id)
             );
         """)
-        try:
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(document_id);")
+        # chunks_au antigo (AFTER UPDATE ON chunks) reindexava no FTS qualquer UPDATE,
+        # inclusive o backfill de text_hash; é recriado só para UPDATE OF text
+        cur.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'chunks_au'")
+        row = cur.fetchone()
+        if row and "UPDATE OF text" not in row[0]:
+            cur.execute("DROP TRIGGER chunks_au")
+        # Hash do texto: trechos repetidos (boilerplate, PDFs com páginas em comum)
+        # são gravados e indexados no FTS uma única vez
+        cur.execute("PRAGMA table_info(chunks)")
+        if "text_hash" not in [row[1] for row in cur.fetchall()]:
+            cur.execute("ALTER TABLE chunks ADD COLUMN text_hash BLOB")
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks_text_hash ON chunks(text_hash);")
+            # Bancos antigos: preenche o hash uma única vez (junto com a coluna);
+            # duplicatas já existentes ficam com NULL
+            cur.execute("SELECT id, text FROM chunks")
+            cur.executemany(
+                "UPDATE OR IGNORE chunks SET text_hash = ? WHERE id = ?",
+                [(chunk_hash(text), chunk_id) for chunk_id, text in cur.fetchall()]
+            )
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks_text_hash ON chunks(text_hash);")
+        # Trechos de cada documento, na ordem: um trecho deduplicado continua
+        # ligado a todos os documentos em que aparece
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'doc_chunks'")
+        new_doc_chunks = cur.fetchone() is None
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS doc_chunks(
+                document_id INTEGER NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                chunk_id INTEGER NOT NULL,
+                PRIMARY KEY(document_id, chunk_index),
+                FOREIGN KEY(document_id) REFERENCES documents(id),
+                FOREIGN KEY(chunk_id) REFERENCES chunks(id)
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_doc_chunks_chunk ON doc_chunks(chunk_id);")
+        if new_doc_chunks:
+            # Bancos antigos: cada trecho pertence ao documento que o gravou
             cur.execute("""
-                CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts
-                USING fts5(text, content='', tokenize='porter');
+                INSERT OR IGNORE INTO doc_chunks(document_id, chunk_index, chunk_id)
+                SELECT document_id, chunk_index, id FROM chunks
             """)
+        if HAS_FTS5:
+            cur.execute("SELECT sql FROM sqlite_master WHERE name = 'chunks_fts'")
+            row = cur.fetchone()
+            if row and row[0] != CHUNKS_FTS_SQL:
+                # Esquema antigo (ex.: contentless): recria e reindexa a partir de chunks
+                cur.execute("DROP TABLE chunks_fts")
+                row = None
+            if not row:
+                cur.execute(CHUNKS_FTS_SQL)
+                cur.execute("INSERT INTO chunks_fts(chunks_fts) VALUES('rebuild')")
+            for trigger in CHUNKS_FTS_TRIGGERS:
+                cur.execute(trigger)
             con.commit()
-        except sqlite3.OperationalError:
-            pass
+        else:
+            print("[FTS5] SQLite sem FTS5: busca desativada (instale pysqlite3-binary)")
     
-    with sqlite3.connect(CHAT_DB_PATH) as con:
+    with get_conn(CHAT_DB_PATH) as con:
         cur = con.cursor()
         cur.execute("""
             CREATE TABLE IF NOT EXISTS conversations(
@@ -596,128 +956,321 @@ def ensure_dirs_and_dbs():
                 FOREIGN KEY(conversation_id) REFERENCES conversations(id)
             );
         """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv_id ON messages(conversation_id, id);")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS answer_cache(
+                key TEXT PRIMARY KEY,
+                answer TEXT,
+                created_at TEXT
+            );
+        """)
         con.commit()
 
+def iter_chunks(pages: Iterable[str], size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> Iterator[str]:
+    """Gera os trechos página a página, sem montar o texto completo do documento.
+
+    Equivale a split_text("\\n".join(pages)), mas só mantém em memória a página
+    atual mais a sobreposição herdada da anterior.
+    """
+    step = size - overlap
+    buf = ""
+    first = True
+    for page in pages:
+        buf = page if first else buf + "\n" + page
+        first = False
+        # Inícios pré-calculados; só corta quando há texto além do trecho,
+        # pois o restante pode continuar na próxima página
+        starts = range(0, len(buf) - size, step)
+        yield from filter(None, (buf[s:s + size].strip() for s in starts))
+        buf = buf[len(starts) * step:]
+    tail = buf.strip()
+    if tail:
+        yield tail
+
 def split_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
-    parts = []
-    start = 0
-    n = len(text)
-    while start < n:
-        end = min(n, start + size)
-        parts.append(text[start:end])
-        start = end - overlap
-        if start < 0:
-            start = 0
-        if end == n:
-            break
-    return [p.strip() for p in parts if p.strip()]
-
-def extract_text_from_pdf(pdf_path: str):
+    return list(iter_chunks([text], size, overlap))
+
+def iter_pdf_pages(pdf_path: str) -> Iterator[str]:
+    """Gera o texto de cada página, com PDFium quando disponível"""
+    if HAS_PDFIUM:
+        try:
+            pdf = pdfium.PdfDocument(pdf_path)
+        except pdfium.PdfiumError:
+            pdf = None  # PDF que o PDFium não abre: tenta o PyPDF2
+        if pdf is not None:
+            yield from _iter_pdfium_pages(pdf)
+            return
+    reader = PdfReader(pdf_path)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+def _iter_pdfium_pages(pdf) -> Iterator[str]:
+    """Gera o texto página a página com o pypdfium2.
+
+    Usa só a camada de texto do PDFium (textpage), que percorre apenas os
+    objetos de texto: operadores gráficos (paths, preenchimentos, cores) são
+    ignorados de propósito. Não usar page.render() nem parsers de layout aqui,
+    pois páginas de gráficos científicos têm streams de vários MB sem texto.
+    """
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            try:
+                yield textpage.get_text_bounded()
+            finally:
+                textpage.close()
+                page.close()
+    finally:
+        pdf.close()
+
+def extract_chunks_from_pdf(pdf_path: str) -> Tuple[List[str], int, str]:
+    """Extrai os trechos de um PDF; retorna (trechos, n_páginas, erro).
+
+    Roda dentro do pool de processos, por isso não chama o Streamlit nem
+    levanta exceções: o erro volta como string para o processo principal.
+    """
+    n_pages = 0
+    def pages():
+        nonlocal n_pages
+        for text in iter_pdf_pages(pdf_path):
+            n_pages += 1
+            yield text
+    try:
+        chunks = list(iter_chunks(pages()))
+        return chunks, n_pages, ""
+    except Exception as e:
+        return [], 0, str(e)
+
+def extract_pdf_batch(pdf_paths: List[str]) -> List[Tuple[str, List[str], int, str]]:
+    """Extrai um lote de PDFs num único envio ao worker (menos IPC)"""
+    return [(path, *extract_chunks_from_pdf(path)) for path in pdf_paths]
+
+def extract_pdfs(pdf_files: List[str]):
+    """Extrai os PDFs em paralelo, gerando (path, trechos, n_páginas, erro) à medida que ficam prontos"""
+    if len(pdf_files) < 2:
+        for path in pdf_files:
+            yield (path, *extract_chunks_from_pdf(path))
+        return
+    workers = os.cpu_count() or 1
+    # Lotes de até PDF_BATCH_SIZE, menores se preciso para ocupar todos os workers
+    size = max(1, min(PDF_BATCH_SIZE, len(pdf_files) // workers))
     try:
-        reader = PdfReader(pdf_path)
-        pages = [p.extract_text() or "" for p in reader.pages]
-        return "\n".join(pages), len(reader.pages)
+        ex = ProcessPoolExecutor(max_workers=workers)
     except Exception as e:
-        st.error(f"Erro ao ler {pdf_path}: {e}")
-        return "", 0
+        # Pool indisponível (ex.: sem fork/semáforos no ambiente): segue em série
+        print(f"[PDF] Extração paralela indisponível: {e}")
+        for path in pdf_files:
+            yield (path, *extract_chunks_from_pdf(path))
+        return
+    with ex:
+        # future -> lote; cada future sai do dict ao ser consumida, liberando os
+        # trechos do lote em vez de segurar o texto da pasta inteira
+        batches = {}
+        for i in range(0, len(pdf_files), size):
+            batch = pdf_files[i:i + size]
+            batches[ex.submit(extract_pdf_batch, batch)] = batch
+        # as_completed: um PDF lento não segura a gravação dos que já terminaram
+        for future in as_completed(list(batches)):
+            batch = batches.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                # Worker morto (OOM, crash do PDFium): não repete a extração no
+                # processo do Streamlit, onde o mesmo crash derrubaria todas as sessões
+                results = [(path, [], 0, f"processo de extração falhou: {e!r}") for path in batch]
+            del future
+            yield from results
+
+def chunk_hash(text: str) -> bytes:
+    """SHA-256 (binário) do texto de um trecho, usado para deduplicar chunks"""
+    return hashlib.sha256(text.encode()).digest()
+
+def file_sha256(path: str) -> str:
+    """SHA-256 do conteúdo do arquivo, lido via mmap (sem copiar para a memória do Python)"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return h.hexdigest()
 
 def index_folder(folder: str):
     folder = folder.strip()
     if not os.path.isdir(folder):
         st.error(f"Pasta não encontrada: {folder}")
         return 0, 0
+    if not HAS_FTS5:
+        # Sem os triggers de chunks_fts os trechos gravados nunca seriam buscáveis
+        st.error("Indexação indisponível: o SQLite deste ambiente não tem FTS5 (instale pysqlite3-binary).")
+        return 0, 0
     new_docs, new_chunks = 0, 0
-    with sqlite3.connect(DOC_DB_PATH) as con:
-        cur = con.cursor()
-        pdf_files = [str(p) for p in Path(folder).rglob("*.pdf")]
-        for path in pdf_files:
+    con, write_lock = get_doc_writer()
+    with write_lock:
+        # write_lock já serializa as cargas: a leitura de `existing` não precisa
+        # da transação de escrita. Filtra os já indexados (por caminho e por
+        # conteúdo) antes de despachar para o pool
+        existing = set()
+        known_hashes = set()
+        for doc_path, doc_hash in con.execute("SELECT path, sha256 FROM documents").fetchall():
+            existing.add(doc_path)
+            known_hashes.add(doc_hash)
+        pdf_files, file_hashes = [], {}
+        for p in Path(folder).rglob("*.pdf"):
+            path = str(p)
+            if path in existing:
+                continue
+            digest = file_sha256(path)
+            if digest in known_hashes:
+                continue  # mesmo PDF já indexado (movido ou copiado)
+            known_hashes.add(digest)
+            file_hashes[path] = digest
+            pdf_files.append(path)
+        for path, chunks, n_pages, error in extract_pdfs(pdf_files):
             filename = os.path.basename(path)
-            cur.execute("SELECT id FROM documents WHERE path = ?", (path,))
-            if cur.fetchone():
+            if error:
+                st.error(f"Erro ao ler {path}: {error}")
                 continue
-            text, n_pages = extract_text_from_pdf(path)
-            if not text.strip():
+            if not chunks:
                 continue
-            cur.execute(
-                "INSERT INTO documents(filename, path, n_pages, added_at) VALUES(?,?,?,?)",
-                (filename, path, n_pages, datetime.utcnow().isoformat())
-            )
-            doc_id = cur.lastrowid
-            for i, chunk in enumerate(split_text(text)):
+            # Uma transação curta por documento: o lock de escrita do documents.db
+            # cobre só os INSERTs, nunca o hash nem a extração dos outros PDFs
+            with con:
+                cur = con.cursor()
+                cur.execute("BEGIN IMMEDIATE")
+                # idx_documents_path é UNIQUE: nunca duplica um caminho já indexado
                 cur.execute(
-                    "INSERT INTO chunks(document_id, chunk_index, text) VALUES(?,?,?)",
-                    (doc_id, i, chunk)
+                    "INSERT OR IGNORE INTO documents(filename, path, n_pages, added_at, sha256) VALUES(?,?,?,?,?)",
+                    (filename, path, n_pages, datetime.utcnow().isoformat(), file_hashes[path])
                 )
-                try:
-                    cur.execute("INSERT INTO chunks_fts(rowid, text) VALUES(?,?)", (cur.lastrowid, chunk))
-                except sqlite3.OperationalError:
-                    pass
-                new_chunks += 1
-            new_docs += 1
-        con.commit()
+                if cur.rowcount == 0:
+                    continue
+                doc_id = cur.lastrowid
+                rows = [(doc_id, i, chunk, chunk_hash(chunk)) for i, chunk in enumerate(chunks)]
+                # chunks_fts é mantido pelos triggers de chunks; OR IGNORE pula
+                # trechos idênticos a outros já gravados (idx_chunks_text_hash)
+                cur.executemany(
+                    "INSERT OR IGNORE INTO chunks(document_id, chunk_index, text, text_hash) VALUES(?,?,?,?)",
+                    rows
+                )
+                new_chunks += cur.rowcount
+                # O documento fica com a lista completa, inclusive os trechos que já existiam
+                cur.executemany(
+                    "INSERT INTO doc_chunks(document_id, chunk_index, chunk_id) "
+                    "SELECT ?, ?, id FROM chunks WHERE text_hash = ?",
+                    ((doc_id, i, text_hash) for doc_id, i, _, text_hash in rows)
+                )
+                new_docs += 1
+    
+        if new_docs:
+            # Estatísticas novas para o planner depois da carga em lote
+            con.execute("PRAGMA analysis_limit=1000")
+            con.execute("ANALYZE")
     
     # Backup após indexação
     backup_to_r2()
     return new_docs, new_chunks
 
+def fts_query(text: str) -> str:
+    """Converte texto livre em expressão MATCH segura: termos entre aspas unidos por OR;
+    termos longos viram prefixo ("arquivo" casa com "arquivos")"""
+    return " OR ".join(
+        f'"{term}"*' if len(term) >= FTS_PREFIX_MIN_LEN else f'"{term}"'
+        for term in re.findall(r"\w+", text)
+    )
+
+def fts_phrase(text: str) -> str:
+    """Expressão MATCH de frase exata com os termos do texto ("" se houver menos de dois)"""
+    terms = re.findall(r"\w+", text)
+    return '"' + " ".join(terms) + '"' if len(terms) > 1 else ""
+
+def _fts_search(cur, match: str, limit: int) -> List[tuple]:
+    # O CTE resolve o top-K no índice FTS5 antes dos JOINs, evitando
+    # que o planner troque o MATCH por uma varredura. Um trecho
+    # deduplicado lista todos os PDFs em que aparece (via doc_chunks);
+    # document_id/chunk_index vêm do primeiro deles (MIN), para a ordenação
+    cur.execute("""
+        WITH fts AS (
+            SELECT rowid, rank AS score
+            FROM chunks_fts
+            WHERE chunks_fts MATCH ?
+            ORDER BY rank LIMIT ?
+        )
+        SELECT c.id, c.text, MIN(dc.document_id) AS document_id,
+               group_concat(DISTINCT d.filename), fts.score, dc.chunk_index
+        FROM fts
+        JOIN chunks c ON c.id = fts.rowid
+        JOIN doc_chunks dc ON dc.chunk_id = c.id
+        JOIN documents d ON d.id = dc.document_id
+        GROUP BY c.id
+        ORDER BY fts.score, document_id, dc.chunk_index
+    """, (match, limit))
+    return cur.fetchall()
+
+def doc_db_stamp() -> Tuple[int, ...]:
+    """Assinatura de documents.db; muda a cada commit"""
+    return db_stamp(DOC_DB_PATH)
+
+@st.cache_data(show_spinner=False, max_entries=256, ttl=600)
+def _cached_search(query: str, top_k: int, stamp: Tuple[int, ...]):
+    """Busca em dois níveis; o stamp do DB na chave invalida após reindexação"""
+    match = fts_query(query)
+    with get_conn(DOC_DB_PATH) as con:
+        cur = con.cursor()
+        # 1º nível: frase exata (o BM25 puro costuma enterrar esses trechos);
+        # 2º nível: BM25 sobre os termos soltos, completando até top_k
+        phrase = fts_phrase(query)
+        rows = _fts_search(cur, phrase, top_k) if phrase else []
+        rows += _fts_search(cur, match, top_k * 2)
+    results, seen = [], set()
+    for chunk_id, *row in rows:
+        if chunk_id not in seen:
+            seen.add(chunk_id)
+            results.append(tuple(row))
+    return results[:top_k]
+
 def search_chunks(query: str, top_k: int = TOP_K):
-    query = query.strip()
-    if not query:
+    if not fts_query(query):
         return []
-    with sqlite3.connect(DOC_DB_PATH) as con:
-        cur = con.cursor()
-        try:
-            cur.execute("""
-                SELECT c.text, c.document_id, d.filename, bm25(chunks_fts)
-                FROM chunks_fts
-                JOIN chunks c ON c.id = chunks_fts.rowid
-                JOIN documents d ON d.id = c.document_id
-                WHERE chunks_fts MATCH ?
-                ORDER BY bm25(chunks_fts) LIMIT ?
-            """, (query, top_k))
-            rows = cur.fetchall()
-            if rows:
-                return rows
-        except sqlite3.OperationalError:
-            pass
-        like = f"%{query}%"
-        cur.execute("""
-            SELECT c.text, c.document_id, d.filename, 0.0
-            FROM chunks c JOIN documents d ON d.id = c.document_id
-            WHERE c.text LIKE ?
-            LIMIT ?
-        """, (like, top_k))
-        return cur.fetchall()
+    if not HAS_FTS5:
+        st.error("Busca indisponível: o SQLite deste ambiente não tem FTS5 (instale pysqlite3-binary).")
+        return []
+    return _cached_search(query.strip(), top_k, doc_db_stamp())
 
 def start_conversation(title: str = "Nova conversa"):
-    with sqlite3.connect(CHAT_DB_PATH) as con:
+    with get_conn(CHAT_DB_PATH) as con:
         cur = con.cursor()
         cur.execute(
             "INSERT INTO conversations(title, created_at) VALUES(?, ?)",
             (title, datetime.utcnow().isoformat())
         )
         con.commit()
-        # Backup após nova conversa
-        backup_to_r2()
-        return cur.lastrowid
+        conversation_id = cur.lastrowid
+    _bump_chat_version()
+    # Backup após nova conversa
+    backup_to_r2()
+    return conversation_id
 
 def add_message(conversation_id: int, role: str, content: str):
-    with sqlite3.connect(CHAT_DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute(
+    add_messages(conversation_id, [(role, content)])
+
+def add_messages(conversation_id: int, messages: List[Tuple[str, str]]):
+    """Grava várias mensagens (role, content) numa única transação"""
+    now = datetime.utcnow().isoformat()
+    with get_conn(CHAT_DB_PATH) as con:
+        con.executemany(
             "INSERT INTO messages(conversation_id, role, content, created_at) VALUES(?,?,?,?)",
-            (conversation_id, role, content, datetime.utcnow().isoformat())
+            [(conversation_id, role, content, now) for role, content in messages]
         )
-        con.commit()
+    _bump_chat_version()
 
 def list_conversations():
-    with sqlite3.connect(CHAT_DB_PATH) as con:
+    with get_conn(CHAT_DB_PATH) as con:
         cur = con.cursor()
         cur.execute("SELECT id, title, created_at FROM conversations ORDER BY id DESC")
         return cur.fetchall()
 
 def get_messages(conversation_id: int):
-    with sqlite3.connect(CHAT_DB_PATH) as con:
+    with get_conn(CHAT_DB_PATH) as con:
         cur = con.cursor()
         cur.execute(
             "SELECT role, content, created_at FROM messages WHERE conversation_id = ? ORDER BY id ASC",
@@ -725,35 +1278,130 @@ def get_messages(conversation_id: int):
         )
         return cur.fetchall()
 
-def llm_answer(question: str, context_chunks: List[str]) -> str:
+def answer_cache_key(model: str, question: str, context_chunks: List[str], previous: str = "") -> str:
+    """Chave do cache de respostas: modelo + pergunta normalizada + trechos + mensagem anterior.
+
+    A mensagem anterior entra na chave para que perguntas de continuação
+    ("e em vermelho?") não reaproveitem a resposta de outra conversa; o modelo,
+    para que trocar ANTHROPIC_MODEL não devolva respostas do modelo antigo.
+    """
+    normalized = " ".join(question.lower().split()).rstrip("?!. ")
+    payload = json.dumps({
+        "model": model or "",
+        "question": normalized,
+        "context": sorted(context_chunks),
+        "previous": previous,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+@st.cache_resource
+def _answer_memo() -> Tuple["OrderedDict[str, str]", threading.Lock]:
+    """LRU em memória (por processo) na frente da tabela answer_cache"""
+    return OrderedDict(), threading.Lock()
+
+def _remember_answer(key: str, answer: str):
+    memo, lock = _answer_memo()
+    with lock:
+        memo[key] = answer
+        memo.move_to_end(key)
+        if len(memo) > ANSWER_MEMO_SIZE:
+            memo.popitem(last=False)
+
+def get_cached_answer(key: str) -> Optional[str]:
+    memo, lock = _answer_memo()
+    with lock:
+        if key in memo:
+            memo.move_to_end(key)
+            return memo[key]
+    with get_conn(CHAT_DB_PATH) as con:
+        cur = con.cursor()
+        cur.execute("SELECT answer FROM answer_cache WHERE key = ?", (key,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    _remember_answer(key, row[0])
+    return row[0]
+
+def save_cached_answer(key: str, answer: str):
+    with get_conn(CHAT_DB_PATH) as con:
+        con.execute(
+            "INSERT OR REPLACE INTO answer_cache(key, answer, created_at) VALUES(?,?,?)",
+            (key, answer, datetime.utcnow().isoformat())
+        )
+    _remember_answer(key, answer)
+
+@st.cache_resource
+def _chat_version() -> Dict[str, int]:
+    """Contador de escritas no chat.db, compartilhado por todas as sessões do processo"""
+    return {"value": 0}
+
+def _bump_chat_version():
+    _chat_version()["value"] += 1
+
+# A versão invalida as escritas deste processo; o ttl cobre as feitas por
+# outro processo no mesmo data/ (ex.: outra réplica do app)
+@st.cache_data(show_spinner=False, max_entries=64, ttl=60)
+def _cached_conversations(version: int):
+    return list_conversations()
+
+@st.cache_data(show_spinner=False, max_entries=256, ttl=60)
+def _cached_messages(conversation_id: int, version: int):
+    return get_messages(conversation_id)
+
+def list_conversations_cached():
+    """list_conversations memoizado; invalida a cada escrita no chat.db"""
+    return _cached_conversations(_chat_version()["value"])
+
+def get_messages_cached(conversation_id: int):
+    """get_messages memoizado; invalida a cada escrita no chat.db"""
+    return _cached_messages(conversation_id, _chat_version()["value"])
+
+def llm_answer(question: str, context_chunks: List[str], previous: str = "") -> str:
+    """Responde com base nos trechos; a resposta do modelo é exibida em streaming
+    no container Streamlit ativo e devolvida completa para ser salva."""
     client, model = get_anthropic_client()
-    system_prompt = (
-        "Você é um assistente técnico. Responda de forma direta e cite trechos do contexto quando possível. "
-        "Se a informação não estiver nos documentos, diga que não encontrou."
-    )
-    context_text = "\n\n".join([f"[Trecho {i+1}] {t}" for i, t in enumerate(context_chunks)])
+    cache_key = answer_cache_key(model, question, context_chunks, previous)
+    cached = get_cached_answer(cache_key)
+    if cached is not None:
+        return cached
+    context_text = "\n\n".join(f"[Trecho {i+1}] {t}" for i, t in enumerate(context_chunks))
     if not client:
         return "⚠️ Nenhuma API key Anthropic encontrada. Trechos relevantes:\n\n" + context_text
     try:
-        msg = client.messages.create(
+        # System e contexto vêm primeiro e marcados com cache_control para que
+        # perguntas repetidas sobre os mesmos trechos reaproveitem o prompt cache
+        with client.messages.stream(
             model=model,
             max_tokens=800,
             temperature=0.1,
-            system=system_prompt + "\nUse EXCLUSIVAMENTE o contexto fornecido.",
+            system=[
+                {
+                    "type": "text",
+                    "text": SYSTEM_PROMPT,
+                    "cache_control": {"type": "ephemeral"},
+                }
+            ],
             messages=[
                 {
                     "role": "user",
-                    "content": f"Pergunta: {question}\n\nContexto:\n{context_text}"
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f"Contexto:\n{context_text}",
+                            "cache_control": {"type": "ephemeral"},
+                        },
+                        {"type": "text", "text": f"Pergunta: {question}"},
+                    ]
                 }
             ],
-        )
-        if hasattr(msg, "content"):
-            parts = []
-            for block in msg.content:
-                if getattr(block, "type", "") == "text":
-                    parts.append(block.text)
-            return "".join(parts).strip() or "(sem resposta)"
-        return str(msg)
+        ) as stream:
+            # Mostra os tokens conforme chegam; write_stream devolve o texto completo
+            answer = st.write_stream(stream.text_stream)
+        answer = (answer or "").strip()
+        if not answer:
+            return "(sem resposta)"
+        save_cached_answer(cache_key, answer)
+        return answer
     except Exception as e:
         return f"Falha ao chamar Anthropic: {e}\n\n{context_text}"
 
@@ -763,7 +1411,7 @@ def main():
     ensure_dirs_and_dbs()
     
     # Verificar autenticação
-    if 'authenticated' not in st.session_state or not st.session_state.authenticated:
+    if not is_authenticated():
         show_login_page()
         return
     
@@ -771,8 +1419,7 @@ def main():
     st.title(f"🧪 {APP_TITLE}")
     
     # Mostrar status do R2
-    r2_status = test_r2_connection()
-    if r2_status['status'] == 'success':
+    if get_r2_client():
         st.caption(f"Bem-vindo, **{st.session_state.username}**! | ☁️ Dados sincronizados com R2")
     else:
         st.caption(f"Bem-vindo, **{st.session_state.username}**! | ⚠️ R2 offline (dados locais)")
@@ -781,7 +1428,7 @@ def main():
     col1, col2, col3 = st.columns([1, 1, 1])
     with col3:
         if st.button("🚪 Logout", key="main_logout"):
-            for key in ['authenticated', 'username', 'conv_id']:
+            for key in ['authenticated', 'username', 'auth_token', 'conv_id']:
                 if key in st.session_state:
                     del st.session_state[key]
             st.rerun()
@@ -816,8 +1463,13 @@ def main():
             saved = 0
             for f in files:
                 out = os.path.join(docs_dir, f.name)
-                with open(out, "wb") as w:
-                    w.write(f.read())
+                try:
+                    # Copia em blocos de 1 MB para não carregar o PDF inteiro na memória
+                    with open(out, "wb") as w:
+                        shutil.copyfileobj(f, w, length=1024 * 1024)
+                except OSError as e:
+                    st.error(f"Erro ao salvar {f.name}: {e}")
+                    continue
                 saved += 1
             st.success(f"{saved} PDF(s) salvo(s) em {docs_dir}. Clique em 'Indexar/Atualizar banco'.")
 
@@ -827,17 +1479,26 @@ def main():
     st.subheader("Pergunte com base nos PDFs")
     question = st.text_input("Digite sua pergunta:", placeholder="Ex.: Como importar dados do Excel no Origin?", key="main_question")
     if st.button("Responder", key="main_answer") and question.strip():
-        add_message(st.session_state.conv_id, "user", question.strip())
+        history = get_messages_cached(st.session_state.conv_id)
+        previous = history[-1][1] if history else ""
         rows = search_chunks(question, TOP_K)
-        context_chunks = [r[0] for r in rows]
-        answer = llm_answer(question.strip(), context_chunks)
-        add_message(st.session_state.conv_id, "assistant", answer)
+        # Ordem estável (documento, trecho) mantém a chave do prompt cache entre reruns
+        context_chunks = [r[0] for r in sorted(rows, key=lambda r: (r[1], r[4]))]
+        # Exibição provisória durante o streaming; depois de salva, a resposta
+        # aparece no histórico abaixo
+        live = st.empty()
+        with live.container():
+            with st.chat_message("assistant"):
+                answer = llm_answer(question.strip(), context_chunks, previous)
+        live.empty()
+        # Pergunta e resposta no mesmo commit
+        add_messages(st.session_state.conv_id, [("user", question.strip()), ("assistant", answer)])
 
     st.divider()
     st.subheader("Conversas salvas")
     cols = st.columns([3,1])
     with cols[0]:
-        convs = list_conversations()
+        convs = list_conversations_cached()
         if convs:
             labels = [f"#{cid} — {title} ({created_at.split('T')[0]})" for cid, title, created_at in convs]
             idx = st.selectbox("Escolha uma conversa:", options=list(range(len(convs))), format_func=lambda i: labels[i], key="main_conv_select")
@@ -848,7 +1509,7 @@ def main():
             st.rerun()
 
     if st.session_state.conv_id:
-        msgs = get_messages(st.session_state.conv_id)
+        msgs = get_messages_cached(st.session_state.conv_id)
         for role, content, created in msgs:
             with st.chat_message("user" if role == "user" else "assistant"):
                 st.markdown(content)